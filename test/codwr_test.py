@@ -1,9 +1,327 @@
+import contextlib
+import re
+
 import ulmo
 
+from httpretty import HTTPretty
+import mock
 import pandas as pd
 
+import test_util
+
+
+class _SoapObject(object):
+    """minimal stand-in for a suds object returned by the CoDWR service"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __iter__(self):
+        return iter(self.__dict__.items())
+
+
+def _stations_for(stations, div, wd, abbrev=None):
+    """mimics the service's station selection by div/wd (0 is all) or abbrev"""
+    return [s for s in stations
+            if (div == 0 or s.div == div) and (wd == 0 or s.wd == wd)
+            and (abbrev is None or s.abbrev == abbrev)]
+
+
+def _mocked_client():
+    """builds a mocked suds client serving two districts in division 1"""
+    districts = [
+        _SoapObject(div=1, wd=1, waterDistrictName='South Platte: Greeley'),
+        _SoapObject(div=1, wd=2, waterDistrictName='South Platte: Denver'),
+        _SoapObject(div=2, wd=11, waterDistrictName='Arkansas: Salida'),
+    ]
+    stations = [
+        _SoapObject(div=1, wd=1, abbrev='PLAGRECO'),
+        _SoapObject(div=1, wd=2, abbrev='PLADENCO'),
+        _SoapObject(div=1, wd=2, abbrev='CHEDENCO'),
+    ]
+    variables = [
+        _SoapObject(abbrev='PLAGRECO', variable='DISCHRG'),
+        _SoapObject(abbrev='PLADENCO', variable='DISCHRG'),
+        _SoapObject(abbrev='PLADENCO', variable='GAGE_HT'),
+        _SoapObject(abbrev='CHEDENCO', variable='DISCHRG'),
+    ]
+
+    client = mock.MagicMock()
+    client.service.GetWaterDistricts.return_value = \
+        _SoapObject(WaterDistrict=districts)
+    client.service.GetSMSTransmittingStations.side_effect = \
+        lambda div, wd, abbrev=None: _SoapObject(
+            Station=_stations_for(stations, div, wd, abbrev))
+    client.service.GetSMSTransmittingStationVariables.side_effect = \
+        lambda div, wd, abbrev=None: _SoapObject(StationVariables=[
+            v for v in variables
+            if v.abbrev in [s.abbrev for s in _stations_for(stations, div, wd, abbrev)]])
+    return client
+
+
+@contextlib.contextmanager
+def _mocked_service(client):
+    """patches the CoDWR suds client and starts with an empty district cache"""
+    with mock.patch('ulmo.codwr.core._get_client', return_value=client), \
+            mock.patch('ulmo.codwr.core._worker_client', return_value=client), \
+            mock.patch.dict('ulmo.codwr.core._districts_cache',
+                            {'ts': 0, 'data': None, 'names': None,
+                             'selections': {}}):
+        yield
+
+
+@contextlib.contextmanager
+def _stubbed_service(**overrides):
+    """serves a stub CoDWR WSDL and SOAP responses to a real suds client,
+    dispatching the SOAP requests on their SOAPAction header. Keyword
+    arguments replace the response file for a SOAP action, either with a
+    file name or with a function choosing the file from the request body.
+    Yields the list of (method, SOAP action) requests served."""
+    responses = {
+        'GetWaterDistricts': 'codwr/get_water_districts.xml',
+        'GetSMSTransmittingStations': 'codwr/get_sms_transmitting_stations.xml',
+        'GetSMSTransmittingStationVariables':
+            'codwr/get_sms_transmitting_station_variables.xml',
+    }
+    responses.update(overrides)
+    served = []
+
+    def request_callback(request, uri, headers):
+        if request.method == 'GET':
+            served.append(('GET', None))
+            response_file = 'codwr/ColoradoWaterSMS.wsdl'
+        else:
+            action = request.headers['SOAPAction'].strip('"').rsplit('/', 1)[-1]
+            served.append(('POST', action))
+            response_file = responses[action]
+            if callable(response_file):
+                response_file = response_file(request.body)
+        with open(test_util.get_test_file_path(response_file), 'rb') as f:
+            return [200, {'content-type': 'text/xml; charset=utf-8'}, f.read()]
+
+    with test_util.temp_dir() as cache_dir:
+        HTTPretty.enable()
+        for method in (HTTPretty.GET, HTTPretty.POST):
+            HTTPretty.register_uri(method, re.compile(r'.*/ColoradoWaterSMS\.asmx.*'),
+                                   body=request_callback)
+        try:
+            with mock.patch('ulmo.codwr.core._suds_client', None), \
+                    mock.patch('ulmo.codwr.core._memory_cache',
+                               ulmo.codwr.core._MemoryCache()), \
+                    mock.patch('ulmo.codwr.core.util.get_ulmo_dir',
+                               return_value=cache_dir), \
+                    mock.patch.dict('ulmo.codwr.core._districts_cache',
+                                    {'ts': 0, 'data': None, 'names': None,
+                                     'selections': {}}):
+                yield served
+        finally:
+            HTTPretty.disable()
+            HTTPretty.reset()
+
+
 def test_get_water_district():
     # get division 1 districts
     wddf = ulmo.codwr.get_water_district(1)
     assert(type(wddf) is pd.DataFrame)
-    print(wddf)
\ No newline at end of file
+    print(wddf)
+
+
+def test_get_station_single_call_per_division():
+    client = _mocked_client()
+    with _mocked_service(client):
+        stations = ulmo.codwr.get_station(div=1)
+
+    assert len(stations) == 3
+    assert client.service.GetSMSTransmittingStations.call_count == 1
+    assert client.service.GetSMSTransmittingStationVariables.call_count == 1
+    pladenco = [s for s in stations if s['abbrev'] == 'PLADENCO'][0]
+    assert pladenco['waterDistrictName'] == 'South Platte: Denver'
+    assert pladenco['parameters'] == ['DISCHRG', 'GAGE_HT']
+
+
+def test_get_station_keeps_all_districts():
+    client = _mocked_client()
+    with _mocked_service(client):
+        stations = ulmo.codwr.get_station(div=1)
+        per_district = [ulmo.codwr.get_station(div=1, wd=d) for d in (1, 2)]
+
+    assert len(stations) >= sum(len(s) for s in per_district)
+
+
+def test_get_station_filters_on_service():
+    client = _mocked_client()
+    with _mocked_service(client):
+        everything = ulmo.codwr.get_station()
+        denver = ulmo.codwr.get_station(div=1, wd=2)
+
+    assert len(everything) == 3
+    assert sorted(s['abbrev'] for s in denver) == ['CHEDENCO', 'PLADENCO']
+    calls = client.service.GetSMSTransmittingStations.call_args_list
+    assert [c[0] for c in calls] == [(0, 0), (1, 2)]
+
+
+def test_get_station_by_abbrev():
+    client = _mocked_client()
+    with _mocked_service(client):
+        stations = ulmo.codwr.get_station(abbrev=['PLAGRECO', 'CHEDENCO'])
+
+    assert [s['abbrev'] for s in stations] == ['PLAGRECO', 'CHEDENCO']
+    assert stations[0]['waterDistrictName'] == 'South Platte: Greeley'
+    assert stations[1]['parameters'] == ['DISCHRG']
+
+
+def test_get_station_without_parameters():
+    client = _mocked_client()
+    with _mocked_service(client):
+        stations = ulmo.codwr.get_station(div=1, with_parameters=False)
+        by_abbrev = ulmo.codwr.get_station(abbrev='PLAGRECO',
+                                           with_parameters=False)
+
+    assert len(stations) == 3
+    assert all(s['parameters'] is None for s in stations + by_abbrev)
+    assert client.service.GetSMSTransmittingStationVariables.call_count == 0
+
+
+def test_iter_stations():
+    client = _mocked_client()
+    with _mocked_service(client):
+        stations = ulmo.codwr.iter_stations(div=1)
+        first = next(stations)
+        stations.close()
+        everything = list(ulmo.codwr.iter_stations(div=1))
+
+    assert first['abbrev'] in ('PLAGRECO', 'PLADENCO', 'CHEDENCO')
+    assert len(everything) == 3
+
+
+def test_iter_water_districts():
+    client = _mocked_client()
+    with _mocked_service(client):
+        districts = list(ulmo.codwr.iter_water_districts(1))
+
+    assert [d['waterDistrictName'] for d in districts] == [
+        'South Platte: Greeley', 'South Platte: Denver']
+
+
+def test_get_water_district_reuses_district_list():
+    client = _mocked_client()
+    with _mocked_service(client):
+        div1 = ulmo.codwr.get_water_district(1)
+        div2 = ulmo.codwr.get_water_district(2)
+
+    assert [d['wd'] for d in div1] == [1, 2]
+    assert [d['wd'] for d in div2] == [11]
+    assert client.service.GetWaterDistricts.call_count == 1
+
+
+def test_get_water_district_reuses_selection():
+    client = _mocked_client()
+    with _mocked_service(client):
+        first = ulmo.codwr.get_water_district(1, as_dataframe=True)
+        first['wd'] = 99
+        second = ulmo.codwr.get_water_district([1], [0])
+        selections = dict(ulmo.codwr.core._districts_cache['selections'])
+
+    assert [d['wd'] for d in second] == [1, 2]
+    assert list(selections) == [((1,), (0,))]
+
+
+def test_get_water_district_with_tuples():
+    client = _mocked_client()
+    with _mocked_service(client):
+        div1 = ulmo.codwr.get_water_district(1, wd=(0,))
+        everything = ulmo.codwr.get_water_district((0,))
+        stations = ulmo.codwr.get_station(div=(0,), wd=(0,))
+
+    assert [d['wd'] for d in div1] == [1, 2]
+    assert [d['wd'] for d in everything] == [1, 2, 11]
+    assert len(stations) == 3
+    calls = client.service.GetSMSTransmittingStations.call_args_list
+    assert [c[0] for c in calls] == [(0, 0)]
+
+
+def test_get_water_district_by_name():
+    client = _mocked_client()
+    with _mocked_service(client):
+        platte = ulmo.codwr.get_water_district(wd='platte', as_dataframe=True)
+        denver = ulmo.codwr.get_water_district(1, wd=['DENVER'])
+        missing = ulmo.codwr.get_water_district(2, wd='platte')
+
+    assert list(platte['wd']) == [1, 2]
+    assert [d['wd'] for d in denver] == [2]
+    assert missing is None
+
+
+def test_call_service_with_suds_client():
+    with _stubbed_service():
+        client = ulmo.codwr.core._get_client(ulmo.codwr.core.CODWR_WSDL_URL)
+        future = ulmo.codwr.core._get_executor().submit(
+            ulmo.codwr.core._call_service, client, 'GetWaterDistricts')
+        districts = future.result().WaterDistrict
+        stations = ulmo.codwr.get_station(div=1)
+
+    assert [d.wd for d in districts] == [1, 2, 11]
+    assert [s['abbrev'] for s in stations] == ['PLADENCO']
+    assert stations[0]['waterDistrictName'] == 'South Platte: Denver'
+    assert stations[0]['parameters'] == ['DISCHRG', 'GAGE_HT']
+
+
+def test_call_service_reuses_worker_client():
+    with _stubbed_service():
+        client = ulmo.codwr.core._get_client(ulmo.codwr.core.CODWR_WSDL_URL)
+        with mock.patch('ulmo.codwr.core._worker_client',
+                        wraps=ulmo.codwr.core._worker_client) as worker_client:
+            ulmo.codwr.core._call_service(client, 'GetWaterDistricts')
+            ulmo.codwr.core._call_service(client, 'GetWaterDistricts')
+
+    assert worker_client.call_count == 1
+
+
+def test_get_station_by_abbrev_with_suds_client():
+    with _stubbed_service():
+        stations = ulmo.codwr.get_station(abbrev='PLADENCO')
+
+    assert [s['abbrev'] for s in stations] == ['PLADENCO']
+    assert stations[0]['waterDistrictName'] == 'South Platte: Denver'
+    assert stations[0]['parameters'] == ['DISCHRG', 'GAGE_HT']
+
+
+def test_get_station_empty_results_with_suds_client():
+    empty_stations = 'codwr/get_sms_transmitting_stations_empty.xml'
+    empty_variables = 'codwr/get_sms_transmitting_station_variables_empty.xml'
+    with _stubbed_service(GetSMSTransmittingStations=empty_stations):
+        no_stations = ulmo.codwr.get_station(div=1, wd=2)
+    with _stubbed_service(GetSMSTransmittingStationVariables=empty_variables):
+        no_variables = ulmo.codwr.get_station(div=1, wd=2)
+
+    assert no_stations is None
+    assert [s['parameters'] for s in no_variables] == [[]]
+
+
+def test_get_station_unknown_abbrev_with_suds_client():
+    def stations_file(body):
+        if b'PLADENCO' in body:
+            return 'codwr/get_sms_transmitting_stations.xml'
+        return 'codwr/get_sms_transmitting_stations_empty.xml'
+
+    with _stubbed_service(GetSMSTransmittingStations=stations_file):
+        stations = ulmo.codwr.get_station(abbrev=['PLADENCO', 'TYPO'])
+
+    assert [s['abbrev'] for s in stations] == ['PLADENCO']
+
+
+def test_get_station_unknown_abbrev():
+    client = _mocked_client()
+    with _mocked_service(client):
+        stations = ulmo.codwr.get_station(abbrev=['TYPO', 'PLAGRECO'])
+
+    assert [s['abbrev'] for s in stations] == ['PLAGRECO']
+
+
+def test_get_station_without_cache_parses_wsdl_once():
+    with _stubbed_service() as served:
+        stations = ulmo.codwr.get_station(div=[1, 2], suds_cache=None)
+
+    assert stations is not None
+    # one GetWaterDistricts request plus stations and variables per division
+    assert len([r for r in served if r[0] == 'POST']) == 5
+    assert len([r for r in served if r[0] == 'GET']) == 1
@@ -1,4 +1,6 @@
 from .core import (
     get_water_district,
-    get_station
+    get_station,
+    iter_water_districts,
+    iter_stations
 )
@@ -14,17 +14,26 @@
     if multiple retrieval sources are used.
 """
 from future import standard_library
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from suds.cache import Cache, ObjectCache
 from suds.client import Client
+from suds.transport import Reply, Transport, TransportError
 # from builtins import str
 # from past.builtins import basestring
 # import contextlib
-# import io
+import io
 # import datetime
 import logging
+import pickle
+import re
+import threading
+import time
 
 # import isodate
-# import requests
-# from ulmo import util
+import requests
+from requests.adapters import HTTPAdapter
+from ulmo import util
 import pandas as pd
 
 standard_library.install_aliases()
@@ -42,8 +51,89 @@ CODWR_SERVICE_URL = "http://= www.dwr.state.co.us/SMS_WebService/ColoradoWaterSM
 # The global SUDS client - do not remove or change!
 _suds_client = None
 
+# The water district list rarely changes, so it is kept for up to
+# _DISTRICTS_CACHE_TTL seconds rather than re-fetched for each request
+_DISTRICTS_CACHE_TTL = 3600
+# (div, wd) selections from the cached list are kept as well, up to
+# _DISTRICTS_SELECTIONS_MAX of them
+_DISTRICTS_SELECTIONS_MAX = 32
+_districts_cache = {'ts': 0, 'data': None, 'names': None, 'selections': {}}
 
-def get_water_district(div=0, wd=0, as_dataframe=False, suds_cache=None):
+# maximum number of concurrent requests made to the CoDWR service
+_MAX_WORKERS = 16
+
+# The global worker pool for concurrent service requests, and the per-worker
+# suds clients - both persist so workers and clients are reused
+_executor = None
+_thread_local = threading.local()
+
+# HTTP session shared by all SOAP requests so connections are kept alive
+# and pooled rather than re-opened for every service call
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+
+
+class _SessionTransport(Transport):
+    """
+    suds transport that sends requests through a (shared) requests.Session
+    instead of suds' default urllib transport, which opens a new connection
+    for each service call.
+    """
+    def __init__(self, session):
+        Transport.__init__(self)
+        self.session = session
+
+    def open(self, request):
+        response = self.session.get(request.url, headers=request.headers,
+                                    timeout=self.options.timeout)
+        if response.status_code >= 400:
+            raise TransportError(response.reason, response.status_code,
+                                 io.BytesIO(response.content))
+        return io.BytesIO(response.content)
+
+    def send(self, request):
+        response = self.session.post(request.url, data=request.message,
+                                     headers=request.headers,
+                                     timeout=self.options.timeout)
+        if response.status_code in (202, 204):
+            return None
+        if response.status_code >= 400:
+            raise TransportError(response.reason, response.status_code,
+                                 io.BytesIO(response.content))
+        return Reply(response.status_code, response.headers, response.content)
+
+
+
+class _MemoryCache(Cache):
+    """
+    suds object cache kept in memory, used when the persistent cache is
+    turned off so the WSDL is still only parsed once per session. Objects
+    are stored pickled, so each client gets its own copy.
+    """
+    def __init__(self):
+        self._objects = {}
+
+    def get(self, id):
+        data = self._objects.get(id)
+        return None if data is None else pickle.loads(data)
+
+    def put(self, id, object):
+        self._objects[id] = pickle.dumps(object, 2)
+        return object
+
+    def purge(self, id):
+        self._objects.pop(id, None)
+
+    def clear(self):
+        self._objects.clear()
+
+
+# the in-memory WSDL cache shared by all clients when suds_cache is None
+_memory_cache = _MemoryCache()
+
+
+def get_water_district(div=0, wd=0, as_dataframe=False, suds_cache=("default",)):
     """ Fetches the list of water divisions/districts matching the
     search criteria available from the Co. DWR site.
 
@@ -64,7 +154,13 @@ def get_water_district(div=0, wd=0, as_dataframe=False, suds_cache=None):
     as_dataframe : boolean
         Indicating whether to return results as a Pandas data
                 frame, default True
-    suds_cache  Cache for SUDS SOAP service, default none
+    suds_cache : ``None`` or tuple
+        SOAP local cache duration for WSDL description and client object.
+        Pass a cache duration tuple like ('days', 3) to set a custom duration.
+        Duration may be in months, weeks, days, hours, or seconds.
+        If unspecified, the default duration (7 days) will be used.
+        Use ``None`` to turn off the persistent cache; the WSDL is then
+        downloaded and parsed once per session.
 
     Note that water district list can be retrieved either by number or (partial) name.
     I.e. wd=[1,2,5] would retrieve water districts 1, 2, and 5 while wd='platte'
@@ -75,44 +171,89 @@ def get_water_district(div=0, wd=0, as_dataframe=False, suds_cache=None):
     Data frame or list of matching water districts
     """
 
-    def district_matches(tgt):
-        # Check if the target water district matches the search criteria
-        # need to handle both ints and strings (including partial matches)
-        # Note: 'tgt' is the generated WaterDistrict object from the SOAP call.
-        if type(wd[0]) is int:
-            return wd == [0] or tgt.wd in wd
-        else:
-            return any((True for frag in wd
-                        if str.lower(frag) in
-                        str.lower(str(tgt.waterDistrictName))))
+    wddf = _select_water_districts(div, wd, suds_cache)
+    if len(wddf) == 0:
+        return None
 
-    # ensure div is a list of ints
-    if type(div) is not list: div = [div]
-    assert all(type(d) is int for d in div)
+    if as_dataframe:
+        # hand out a copy - the selection is cached
+        # wddf.rename(columns = {'div':'wdiv'}, inplace = True)
+        return wddf.copy()
 
-    # ensure wd is a homogeneous list of either int ot str
-    if type(wd) is not list: wd = [wd]
-    assert type(wd[0]) in [int, str] and all(type(w) is type(wd[0]) for w in wd)
+    return wddf.to_dict('records')
 
-    # retrieve the list of water districts
-    suds_client = _get_client(CODWR_WSDL_URL)
-    wda = suds_client.service.GetWaterDistricts()
 
-    wds = []
-    for wdx in wda.WaterDistrict:
-        if (div == [0] or wdx.div in div) and district_matches(wdx):
-            wdd = dict(wdx)
-            wds.append(wdd)
+def iter_water_districts(div=0, wd=0, suds_cache=("default",)):
+    """ Iterates over the water divisions/districts matching the search
+    criteria available from the Co. DWR site, yielding one district dict at
+    a time. See ``get_water_district`` for the parameters.
+    """
+    wddf = _select_water_districts(div, wd, suds_cache)
+    for row in wddf.itertuples(index=False):
+        yield dict(zip(wddf.columns, row))
 
-    if as_dataframe:
-        wds = pd.DataFrame(wds)
-        # wds.rename(columns = {'div':'wdiv'}, inplace = True)
 
-    return wds if len(wds) > 0 else None
+def _select_water_districts(div, wd, suds_cache):
+    """Returns the data frame of water districts matching div and wd (see
+    ``get_water_district``), fetching the district list if necessary."""
+    # ensure div is a list of ints - only sequences need their items checked
+    if isinstance(div, int):
+        div = [div]
+    else:
+        div = list(div)
+        if __debug__:
+            assert all(type(d) is int for d in div)
+
+    # ensure wd is a homogeneous list of either int ot str
+    if isinstance(wd, (int, str)):
+        wd = [wd]
+    else:
+        wd = list(wd)
+        if __debug__:
+            assert type(wd[0]) in [int, str] and all(type(w) is type(wd[0]) for w in wd)
+
+    # retrieve the list of water districts (or reuse a recently retrieved list)
+    if (_districts_cache['data'] is None
+            or time.time() - _districts_cache['ts'] >= _DISTRICTS_CACHE_TTL):
+        suds_client = _get_client(CODWR_WSDL_URL, suds_cache)
+        wda = suds_client.service.GetWaterDistricts()
+        _districts_cache['data'] = pd.DataFrame(
+            [(wdx.div, wdx.wd, wdx.waterDistrictName) for wdx in wda.WaterDistrict],
+            columns=['div', 'wd', 'waterDistrictName'])
+        # lower case the names once here rather than on every name search
+        _districts_cache['names'] = \
+            _districts_cache['data']['waterDistrictName'].astype(str).str.lower()
+        _districts_cache['selections'] = {}
+        _districts_cache['ts'] = time.time()
+
+    # reuse the result of an identical earlier selection
+    key = (tuple(div), tuple(wd))
+    selections = _districts_cache['selections']
+    if key in selections:
+        return selections[key]
+
+    # select the matching districts - water districts may be given either by
+    # number or as (partial, case insensitive) names
+    wddf = _districts_cache['data']
+    mask = pd.Series(True, index=wddf.index)
+    if div != [0]:
+        mask &= wddf['div'].isin(div)
+    if type(wd[0]) is int:
+        if wd != [0]:
+            mask &= wddf['wd'].isin(wd)
+    else:
+        pattern = '|'.join(re.escape(frag.lower()) for frag in wd)
+        mask &= _districts_cache['names'].str.contains(pattern, regex=True)
+
+    if len(selections) >= _DISTRICTS_SELECTIONS_MAX:
+        selections.clear()
+    selections[key] = wddf[mask].reset_index(drop=True)
+    return selections[key]
 
 
 def get_station(div=0, wd=0, abbrev=None, as_dataframe=False,
-                input_file=None, output_file=None, suds_cache=None):
+                input_file=None, output_file=None, suds_cache=("default",),
+                with_parameters=True):
     """Fetches a list of currently active CoDWR sites by name. If an input file is
     provided the list of site names in the file will be retrieved, otherwise the
     CoDWR web service will be queried.
@@ -125,98 +266,262 @@ def get_station(div=0, wd=0, abbrev=None, as_dataframe=False,
     as_dataframe  : Return information as a Pandas DataFrame (default is False)
     input_file  : Path to file or file object (default is None).
     output_file : Path to output file or file object (default is None).
+    suds_cache  : SOAP local cache duration tuple for the WSDL description,
+                  e.g. ('days', 3), or None to only keep it for the session
+                  (default is 7 days).
+    with_parameters : Retrieve the parameters measured at each station
+                  (default is True). Skipping them saves a service request
+                  per division/station; the station 'parameters' entry is
+                  then None. Callers looking up stations by abbrev only
+                  for their location/district rarely need them.
 
     Returns
     =======
         stations : a list of dicts of stations or the equivalent DataFrame
     """
+    if input_file is None:
+        # use the Co DWR SOAP service
+        stations = list(_iter_stations(div, wd, abbrev, suds_cache,
+                                       with_parameters, in_order=True))
+    else:
+        # retrieve the list of sites in the specified file
+        print("Nothing yet")
+        stations = []
+
+    if as_dataframe is True:
+        stations = pd.DataFrame(stations)
+
+    return stations if len(stations) > 0 else None
+
+
+def iter_stations(div=0, wd=0, abbrev=None, suds_cache=("default",),
+                  with_parameters=True):
+    """Iterates over the currently active CoDWR sites, yielding each station
+    dict as soon as the service response containing it arrives. Stations are
+    not yielded in any particular order and outstanding requests are
+    cancelled if the iteration is stopped early. See ``get_station`` for the
+    parameters.
+    """
+    return _iter_stations(div, wd, abbrev, suds_cache, with_parameters,
+                          in_order=False)
+
+
+def _iter_stations(div, wd, abbrev, suds_cache, with_parameters, in_order):
+    """Generates the station dicts for ``get_station``/``iter_stations``,
+    either in request order or in the order the responses arrive."""
     # ensure div is a list of ints
-    if type(div) is not list: div = [div]
+    div = [div] if isinstance(div, int) else list(div)
     # ensure wd is a list
-    if type(wd) is not list: wd = [wd]
+    wd = [wd] if isinstance(wd, (int, str)) else list(wd)
     # ensure name is a homogeneous list of str if it exists
-    if abbrev is not None and type(abbrev) is not list:
+    if isinstance(abbrev, str):
         abbrev = [abbrev]
+    elif __debug__ and abbrev is not None:
         assert all(type(a) is str for a in abbrev)
 
-    stations = []
-    if input_file is None:
-        # use the Co DWR SOAP service
-        suds_client = _get_client(CODWR_WSDL_URL)
-
-        # get the water division/districts
-        dists = get_water_district(div, wd, as_dataframe=False, suds_cache=suds_cache)
-        if dists is None:
-            # no matching division/district(s)
-            return None
-
-        if abbrev is None:
+    suds_client = _get_client(CODWR_WSDL_URL, suds_cache)
+
+    # get the water division/districts
+    dists = get_water_district(div, wd, as_dataframe=False, suds_cache=suds_cache)
+    if dists is None:
+        # no matching division/district(s)
+        return
+
+    # index the selected districts by (div, wd) so the stations returned
+    # (e.g. for a whole division) can be matched to their district locally
+    dist_index = {(d['div'], d['wd']): d for d in dists}
+
+    if abbrev is None:
+        # fetch the stations and their parameters once per division
+        # (wd=0 retrieves all of the division's districts) rather than
+        # once per district - the round-trips dominate the run time so
+        # the (independent) requests are issued concurrently. Let the
+        # service do the filtering where a single request covers the
+        # selection: everything (div=0, wd=0) or a division's only
+        # selected district.
+        if div == [0] and wd == [0]:
+            queries = [(0, 0)]
+        else:
+            div_wds = defaultdict(list)
             for d in dists:
-                # get the stations for the division/district
-                sites = suds_client.service.GetSMSTransmittingStations(d['div'], d['wd'])
-                if sites is None:
-                    return None
-
-                # get the parameters for the stations
-                sparms = suds_client.service.GetSMSTransmittingStationVariables(d['div'], d['wd'])
-                if sparms is None:
-                    # hmmm - we have stations but no parameters...
-                    raise ValueError("Service returned no parameters for transmitting station(s).")
-
-                # the SOAP service returns each parameter for a station as a
-                # separate row <abbrev, parameter> which we will compact into
-                # a dict {abbrev,[parameter,parameter,...]}
-                params = {}
-                for sp in sparms.StationVariables:
-                    spd = dict(sp)
-                    if spd['abbrev'] not in params:
-                        params[spd['abbrev']] = []
-                    params[spd['abbrev']].append(spd['variable'])
+                div_wds[d['div']].append(d['wd'])
+            queries = [(dv, div_wds[dv][0] if len(div_wds[dv]) == 1 else 0)
+                       for dv in sorted(div_wds)]
+
+        executor = _get_executor()
+        site_futures = [executor.submit(_call_service, suds_client,
+                                        'GetSMSTransmittingStations', dv, dwd)
+                        for dv, dwd in queries]
+        if with_parameters:
+            sparm_futures = [executor.submit(_call_service, suds_client,
+                                             'GetSMSTransmittingStationVariables', dv, dwd)
+                             for dv, dwd in queries]
+        else:
+            sparm_futures = [None] * len(queries)
+
+        # the caller may stop iterating early, so hand out the stations as the
+        # responses arrive and skip whatever requests are still outstanding
+        position = dict((f, i) for i, f in enumerate(site_futures))
+        try:
+            for site_future in (site_futures if in_order
+                                else as_completed(site_futures)):
+                sparm_future = sparm_futures[position[site_future]]
+
+                # get the stations for the division/district - the service
+                # returns an empty result if there are none
+                sites = site_future.result()
+                if not sites or not getattr(sites, 'Station', None):
+                    continue
+
+                params = None
+                if sparm_future is not None:
+                    # get the parameters for the stations
+                    sparms = sparm_future.result()
+                    if sparms is None:
+                        # hmmm - we have stations but no parameters...
+                        raise ValueError("Service returned no parameters for transmitting station(s).")
+
+                    # the SOAP service returns each parameter for a station as a
+                    # separate row <abbrev, parameter> which we will compact into
+                    # a dict {abbrev,[parameter,parameter,...]}
+                    params = defaultdict(list)
+                    for sp in getattr(sparms, 'StationVariables', None) or []:
+                        params[sp.abbrev].append(sp.variable)
 
                 # build up the complete station description (including the water
-                # district name and parameters) and add it to the station list
-                # to the station list
+                # district name and parameters) for the stations in the selected
+                # districts and hand it out
                 for site in sites.Station:
                     sited = dict(site)
+                    d = dist_index.get((sited['div'], sited['wd']))
+                    if d is None:
+                        # station is in a district that was not requested
+                        continue
                     sited['waterDistrictName'] = d['waterDistrictName']
-                    sited['parameters'] = params[sited['abbrev']]
-                    stations.append(sited)
+                    sited['parameters'] = (None if params is None
+                                           else params.get(sited['abbrev'], []))
+                    yield sited
+        finally:
+            for future in site_futures + sparm_futures:
+                if future is not None:
+                    future.cancel()
 
-        else:
-            for a in abbrev:
-                site = suds_client.service.GetSMSTransmittingStations(0, 0, a)
-                if site is not None:
-                    sited = dict(site)
+    else:
+        # look the stations up concurrently - the service takes a single
+        # station abbrev per request
+        executor = _get_executor()
+        futures = [executor.submit(_fetch_station, suds_client, a, with_parameters)
+                   for a in abbrev]
+        try:
+            for future in futures if in_order else as_completed(futures):
+                sited = future.result()
+                if sited is None:
+                    continue
+
+                d = dist_index.get((sited['div'], sited['wd']))
+                if d is not None:
+                    sited['waterDistrictName'] = d['waterDistrictName']
 
-                    for d in dists:
-                        if d['div'] == sited['div'] and d['wd'] == sited['wd']:
-                            sited['waterDistrictName'] = d['waterDistrictName']
-                            break
+                yield sited
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _fetch_station(suds_client, abbrev, with_parameters):
+    """Fetches a single station (and optionally its parameters) by abbrev,
+    returning the station dict or None if the station doesn't exist."""
+    sites = _call_service(suds_client, 'GetSMSTransmittingStations', 0, 0, abbrev)
+    if not sites or not getattr(sites, 'Station', None):
+        # the service returns an empty result for unknown stations
+        return None
+    sited = dict(sites.Station[0])
+
+    sited['parameters'] = None
+    if with_parameters:
+        # retrieve the station parameters and attach them to the
+        # station information
+        sparms = _call_service(suds_client, 'GetSMSTransmittingStationVariables',
+                               sited['div'], sited['wd'], sited['abbrev'])
+        if sparms is None:
+            # hmmm - we have stations but no parameters...
+            raise ValueError("Service returned no parameters for station "
+                             + sited['abbrev'])
+        sited['parameters'] = []
+        for sp in getattr(sparms, 'StationVariables', None) or []:
+            assert(sp.abbrev == sited['abbrev'])
+            sited['parameters'].append(sp.variable)
+
+    return sited
+
+
+def _call_service(suds_client, method, *args):
+    """
+    Invoke a SOAP service method on the calling worker thread's own suds
+    client for the service of the shared client. suds clients are not
+    thread-safe, so each worker creates its own client once (loading the
+    parsed WSDL from the shared cache) and reuses it for all of its requests.
 
-                    # retrieve the station parameters and attach them to the
-                    # station information
-                    sparms = suds_client.service.GetSMSTransmittingStationVariables(sited['div'],
-                                                                                    sited['wd'],
-                                                                                    sited['abbrev'])
-                    if sparms is None:
-                        # hmmm - we have stations but no parameters...
-                        raise ValueError("Service returned no parameters for station "
-                                         + sited['abbrev'])
-                    for sp in sparms.StationVariables:
-                        spd = dict(sp)
-                        if sited['parameters'] is None:
-                            sited['parameters'] = []
-                        assert(spd['abbrev'] == sited['abbrev'])
-                        sited['parameters'].append(spd['variable'])
+    Parameters
+    ----------
+    suds_client : suds Client
+        The shared client returned by ``_get_client``.
+    method : str
+        Name of the service method to invoke.
+    args
+        Positional arguments passed to the service method.
 
-    else:
-        # retrieve the list of sites in the specified file
-        print("Nothing yet")
+    Returns
+    -------
+    The service method's response.
+    """
+    if getattr(_thread_local, 'source', None) is not suds_client:
+        _thread_local.source = suds_client
+        _thread_local.client = _worker_client(suds_client)
 
-    if as_dataframe is True:
-        stations = pd.DataFrame(stations)
+    return getattr(_thread_local.client.service, method)(*args)
 
-    return stations if len(stations) > 0 else None
+
+def _worker_client(suds_client):
+    """
+    Create a new suds client for the service of the shared client
+    suds_client, using the same WSDL cache and HTTP session. (suds'
+    Client.clone() can't be used - deep copying the client options
+    recurses endlessly on Python 3.)
+
+    Parameters
+    ----------
+    suds_client : suds Client
+        The shared client returned by ``_get_client``.
+
+    Returns
+    -------
+    suds Client
+        A new client for the same WSDL.
+    """
+    options = suds_client.options
+    return Client(suds_client.wsdl.url, cache=options.cache,
+                  cachingpolicy=options.cachingpolicy,
+                  transport=_SessionTransport(_session))
+
+
+def _get_executor():
+    """
+    Open and re-use (persist) the ThreadPoolExecutor _executor used to issue
+    concurrent service requests, so its worker threads (and their suds
+    clients) live for the whole session.  _executor is global in scope.
+
+    Returns
+    -------
+    _executor : ThreadPoolExecutor
+        Newly or previously instantiated (reused) executor.
+    """
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+
+    return _executor
 
 
 def _get_client(wsdl_url, cache_duration=("default",)):
@@ -234,8 +539,9 @@ def _get_client(wsdl_url, cache_duration=("default",)):
         object. Pass a cache duration tuple like ('days', 3) to set a
         custom duration. Duration may be in months, weeks, days, hours,
         or seconds.
-        If unspecified, the suds default (1 day) will be used.
-        Use ``None`` to turn off caching.
+        If unspecified, a duration of 7 days will be used.
+        Use ``None`` to turn off the persistent cache; the WSDL is then
+        downloaded and parsed once per session.
 
     Returns
     -------
@@ -244,20 +550,25 @@ def _get_client(wsdl_url, cache_duration=("default",)):
     """
     global _suds_client
 
-    print(wsdl_url)
+    log.debug("Opening SUDS client for %s", wsdl_url)
     # Handle new or changed client request (create new client)
     if _suds_client is None or _suds_client.wsdl.url != wsdl_url:
-        _suds_client = Client(wsdl_url)
         if cache_duration is None:
-            _suds_client.set_options(cache=None)
+            # no persistent cache, but keep the parsed WSDL in memory so the
+            # per-worker clients don't download and parse it again
+            _suds_client = Client(wsdl_url, cache=_memory_cache, cachingpolicy=1,
+                                  transport=_SessionTransport(_session))
         else:
-            cache = _suds_client.options.cache
-            # could add some error catching ...
+            # keep the parsed WSDL in a persistent cache so later sessions
+            # don't have to download and parse the service description again
             if cache_duration[0] == "default":
-                cache.setduration(days=1)
+                cache = ObjectCache(location=util.get_ulmo_dir('suds_cache'), days=7)
             else:
                 # noinspection PyTypeChecker
-                cache.setduration(**dict([cache_duration]))
+                cache = ObjectCache(location=util.get_ulmo_dir('suds_cache'),
+                                    **dict([cache_duration]))
+            _suds_client = Client(wsdl_url, cache=cache, cachingpolicy=1,
+                                  transport=_SessionTransport(_session))
 
     return _suds_client
 